@@ -4,22 +4,57 @@ from __future__ import print_function
 
 import argparse
 import datetime as dt
+import io
 import json
 import os
 import platform
-import shlex
+import re
 import smtplib
-import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 
-import feedparser
+import requests
+from requests.adapters import HTTPAdapter
 
-# python 2 and 3 do different things with urllib
+# lxml's C-backed parser is noticeably faster on big feeds, but the
+# stdlib ElementTree speaks the same iterparse API and keeps us
+# dependency-light if lxml isn't installed
 try:
-    from urllib.request import urlopen
+    from lxml import etree
 except ImportError:
-    from urllib2 import urlopen
+    from xml.etree import ElementTree as etree
+
+# a single shared session so that all of our arxiv queries reuse
+# keep-alive connections instead of paying a fresh TCP/TLS handshake
+# per category
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# pyahocorasick lets us scan each paper's text for every keyword in a
+# single pass -- if it's not installed we fall back to one substring
+# search per keyword
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# the namespace prefix for elements in the Atom feed returned by the
+# arxiv API
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+# a keyword line in the inputs file is the keyword itself, an optional
+# trailing "-" marking unique matching, and an optional "not:" clause
+# followed by a comma-separated list of exclude terms.  Anchoring the
+# "-" to the end of the keyword means hyphens inside a keyword (e.g.
+# "x-ray burst") are left alone
+KW_RE = re.compile(r"^(?P<kw>.+?)(?P<unique>-)?(?:\s+not:\s*(?P<nots>.*))?$")
+
+# translation table collapsing line breaks and tabs to spaces --
+# str.translate with a prebuilt table is the cheapest way to normalize
+# the abstract text
+_WS_TABLE = str.maketrans("\n\r\t", "   ")
 
 ArxivCategoryMap = {"astro-ph": ["GA", "CO", "EP", "HE", "IM", "SR"],
                     "cond-mat": ["dis-nn", "mes-hall", "mtrl-sci", "other", "quant-gas", "soft", "stat-mech", "str-el", "supr-con"],
@@ -49,19 +84,77 @@ def ArxivCategoryIterator(category):
                 # this will catch cases where the category has no subcategories
                 yield category
 
+def _parse_arxiv_atom(stream):
+    """stream the Atom feed returned by the arxiv API, yielding a dict
+       with the id, title, summary, and alternate-link url of each
+       entry.  These are the only fields the keyword search needs, so
+       unlike a full-blown feed parser we do no date parsing or HTML
+       sanitization, and each entry element is cleared once consumed so
+       the in-memory tree never grows"""
+
+    for _, entry in etree.iterparse(stream, events=("end",)):
+        if entry.tag != ATOM + "entry":
+            continue
+
+        url = None
+        for l in entry.findall(ATOM + "link"):
+            if l.get("rel") == "alternate":
+                url = l.get("href")
+
+        yield {"id": entry.findtext(ATOM + "id"),
+               "title": entry.findtext(ATOM + "title"),
+               "summary": entry.findtext(ATOM + "summary"),
+               "link": url}
+
+        # free the element now that we've pulled out what we need --
+        # with lxml we can also drop any already-parsed siblings
+        entry.clear()
+        if hasattr(entry, "getprevious"):
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+
+
+def _id_key(arxiv_id):
+    """turn an arxiv id like "2401.12345v2" into a (yymm, number)
+       tuple for ordering comparisons.  Parsing the id as a float is
+       lossy once the sequence number grows enough digits"""
+
+    yymm, num = arxiv_id.split("v")[0].split(".")
+    return int(yymm), int(num)
+
+
 class Paper:
     """a Paper is a single paper listed on arXiv.  In addition to the
        paper's title, ID, and URL (obtained from arXiv), we also store
        which keywords it matched and which Slack channel it should go
        to"""
 
+    # we can hold on to ~1000 of these per category, so skip the
+    # per-instance __dict__
+    __slots__ = ("arxiv_id", "title", "url", "keywords", "channels",
+                 "channel_set", "posted_to_slack", "_kw_str", "_sort_key")
+
     def __init__(self, arxiv_id, title, url, keywords, channels):
         self.arxiv_id = arxiv_id
         self.title = title.replace("'", r"")
         self.url = url
         self.keywords = list(keywords)
-        self.channels = list(set(channels))
+        # dict.fromkeys dedups while keeping the original order, and
+        # tolerates channels being None
+        self.channels = list(dict.fromkeys(channels or ()))
+        # frozenset for O(1) "does this paper go to channel c?" tests
+        self.channel_set = frozenset(self.channels)
         self.posted_to_slack = 0
+        self._cache_sort_key()
+
+    def _cache_sort_key(self):
+        """sort the keywords and cache the joined keyword string and
+           the sort key -- sorting calls kw_str()/__lt__ O(N log N)
+           times, so we don't want to rebuild these per comparison"""
+
+        self.keywords.sort()
+        self._kw_str = ", ".join(self.keywords)
+        self._sort_key = (len(self.keywords), self._kw_str)
 
     def __eq__(self, other):
         return self.arxiv_id == other.arxiv_id
@@ -75,16 +168,13 @@ class Paper:
 
     def kw_str(self):
         """ return the union of keywords """
-        return ", ".join(self.keywords)
+        return self._kw_str
 
     def __lt__(self, other):
         """we compare Papers by the number of keywords, and then
            alphabetically by the union of their keywords"""
 
-        if len(self.keywords) == len(other.keywords):
-            return self.kw_str() < other.kw_str()
-
-        return len(self.keywords) < len(other.keywords)
+        return self._sort_key < other._sort_key
 
 
 class Keyword:
@@ -93,10 +183,23 @@ class Keyword:
        the match, and what Slack channel this keyword is associated with"""
 
     def __init__(self, name, matching="any", channel=None, excludes=None):
-        self.name = name
+        # matching is done against lowercased text, so normalize the
+        # terms here once rather than relying on callers to pass them
+        # in lowercase
+        self.name = name.lower()
         self.matching = matching
         self.channel = channel
-        self.excludes = list(set(excludes))
+        # dedup while preserving order, and don't blow up on the
+        # default excludes=None
+        self.excludes = tuple(dict.fromkeys(x.lower() for x in excludes or ()))
+
+        # "unique" means match as a whole word only, which is exactly a
+        # word-boundary regex search -- the keyword set is fixed for
+        # the whole run, so compile it once here
+        if matching == "unique":
+            self._unique_re = re.compile(r"\b" + re.escape(self.name) + r"\b")
+        else:
+            self._unique_re = None
 
     def __str__(self):
         return "{}: matching={}, channel={}, NOTs={}".format(
@@ -120,18 +223,14 @@ class ArxivQuery:
         self.category = category
         self.categories = list(ArxivCategoryIterator(self.category))
 
+        # the category list is fixed for this query, so build the OR
+        # clause once -- %28/%29 are the url-encoded parentheses
+        self._cat_query = "%28" + "+OR+".join(self.categories) + "%29"
+
     def get_cat_query(self):
         """ create the category portion of the arxiv query """
 
-        cat_query = "%28"  # open parenthesis
-        for n, s in enumerate(self.categories):
-            cat_query += s
-            if n < len(self.categories)-1:
-                cat_query += "+OR+"
-            else:
-                cat_query += "%29"  # close parenthesis
-
-        return cat_query
+        return self._cat_query
 
     def get_range_query(self):
         """ get the query string for the date range """
@@ -152,31 +251,33 @@ class ArxivQuery:
 
         return self.base_url + full_query
 
-    def do_query(self, keywords=None, old_id=None):
+    def do_query(self, keywords=None, old_id=None, automaton=None):
         """ perform the actual query """
 
-        # note, in python3 this will be bytes not str
-        response = urlopen(self.get_url()).read()
-        response = response.replace(b"author", b"contributor")
-
-        # this feedparser magic comes from the example of Julius Lucks / Andrea Zonca
-        # https://github.com/zonca/python-parse-arxiv/blob/master/python_arXiv_parsing_example.py
-        #feedparser._FeedParserMixin.namespaces['http://a9.com/-/spec/opensearch/1.1/'] = 'opensearch'
-        #feedparser._FeedParserMixin.namespaces['http://arxiv.org/schemas/atom'] = 'arxiv'
+        response = _SESSION.get(self.get_url(), stream=True)
+        response.raw.decode_content = True
 
-        feed = feedparser.parse(response)
-
-        if feed.feed.opensearch_totalresults == 0:
-            sys.exit("no results found")
+        # buffer the socket reads so the parser pulls the response in
+        # big chunks instead of lots of small recv calls -- at no point
+        # do we hold more than the buffer in memory
+        stream = io.BufferedReader(response.raw, buffer_size=64*1024)
 
         results = []
 
         latest_id = None
+        old_key = _id_key(old_id) if old_id is not None else None
 
-        for e in feed.entries:
+        n_entries = 0
+        n_below = 0  # consecutive entries below the old-id cutoff
 
-            arxiv_id = e.id.split("/abs/")[-1]
-            title = e.title.replace("\n", " ")
+        # stream the Atom feed entry-by-entry instead of reading the
+        # whole response into memory
+        for entry in _parse_arxiv_atom(stream):
+
+            arxiv_id = entry["id"].split("/abs/")[-1]
+            title = entry["title"].replace("\n", " ")
+            abstract = entry["summary"]
+            url = entry["link"]
 
             # the papers are sorted now such that the first is the
             # most recent -- we want to store this id, so the next
@@ -186,55 +287,82 @@ class ArxivQuery:
 
             # now check if we hit the old_id -- this is where we
             # left off last time.  Note things may not be in id order,
-            # so we keep looking through the entire list of returned
-            # results.
-            if old_id is not None:
-                # strip off any version number at the end, e.g. vN
-                if float(arxiv_id.split("v")[0]) < float(old_id.split("v")[0]):
+            # so we keep looking through the returned results -- but
+            # once we are well past the cutoff and see a long
+            # uninterrupted run of old entries, everything further down
+            # is stale too, and breaking here stops us from pulling the
+            # rest of the feed off the socket
+            n_entries += 1
+            if old_key is not None:
+                if _id_key(arxiv_id) < old_key:
+                    n_below += 1
+                    if n_entries >= 200 and n_below >= 50:
+                        break
                     continue
+                n_below = 0
+
+            # lowercase the text once per entry -- every keyword (and
+            # every exclude) matches against the same strings, so
+            # there is no reason to redo this in the keyword loop
+            abs_lower = abstract.lower().translate(_WS_TABLE)
+            title_lower = title.lower()
+
+            # if we have an automaton, scan the text once for every
+            # "any" keyword and exclude term up front -- the matching
+            # below then reduces to set membership tests
+            if automaton is not None:
+                hits = {w for _, w in automaton.iter(abs_lower + "\n" + title_lower)}
+            else:
+                hits = None
+
+            def get_match(k):
+                """check a single keyword against this entry.  We do two
+                   types of matches here.  If the keyword has the "any"
+                   qualifier, then we don't care how it appears in the
+                   text, but if it has "unique", then we want to make
+                   sure only that word matches, i.e., "nova" and not
+                   "supernova".  If any of the exclude words associated
+                   with the keyword are present, then we reject any
+                   match"""
+
+                # first check the "NOT"s -- any exclude hit rejects the
+                # keyword outright, so bail as soon as we see one
+                if hits is not None:
+                    if any(n in hits for n in k.excludes):
+                        return False
+                    if k.matching == "any":
+                        return k.name in hits
+                else:
+                    if any(n in abs_lower or n in title_lower
+                           for n in k.excludes):
+                        return False
+                    if k.matching == "any":
+                        return k.name in abs_lower or k.name in title_lower
 
-            # link
-            for l in e.links:
-                if l.rel == "alternate":
-                    url = l.href
-
-            abstract = e.summary
+                return k.matching == "unique" and \
+                    bool(k._unique_re.search(abs_lower) or
+                         k._unique_re.search(title_lower))
 
             # any keyword matches?
-            # we do two types of matches here.  If the keyword tuple has the "any"
-            # qualifier, then we don't care how it appears in the text, but if
-            # it has "unique", then we want to make sure only that word matches,
-            # i.e., "nova" and not "supernova".  If any of the exclude words associated
-            # with the keyword are present, then we reject any match
             keys_matched = []
             channels = []
             for k in keywords:
-                # first check the "NOT"s
-                excluded = False
-                for n in k.excludes:
-                    if n in abstract.lower().replace("\n", " ") or n in title.lower():
-                        # we've matched one of the excludes
-                        excluded = True
-
-                if excluded:
-                    continue
-
-                if k.matching == "any":
-                    if k.name in abstract.lower().replace("\n", " ") or k.name in title.lower():
-                        keys_matched.append(k.name)
-                        channels.append(k.channel)
-
-                elif k.matching == "unique":
-                    qa = [l.lower().strip('\":.,!?') for l in abstract.split()]
-                    qt = [l.lower().strip('\":.,!?') for l in title.split()]
-                    if k.name in qa + qt:
-                        keys_matched.append(k.name)
-                        channels.append(k.channel)
+                if get_match(k):
+                    keys_matched.append(k.name)
+                    channels.append(k.channel)
 
             # multiple channels can list the same keyword, so do not double count them
-            keys_matched = list(set(keys_matched))
+            keys_matched = list(dict.fromkeys(keys_matched))
             if keys_matched:
-                results.append(Paper(arxiv_id, title, url, keys_matched, channels))
+                results.append(Paper(arxiv_id, title, url, keys_matched,
+                                     dict.fromkeys(channels)))
+
+        # if we broke out early there may be unread bytes left; close
+        # the response so the connection is cleaned up
+        response.close()
+
+        if latest_id is None:
+            sys.exit("no results found")
 
         return results, latest_id
 
@@ -254,6 +382,31 @@ def report(body, subject, sender, receiver):
         sys.exit("ERROR sending mail")
 
 
+def build_automaton(keywords):
+    """build an Aho-Corasick automaton over the names of the "any"
+       keywords and all of the exclude terms, so each paper's text can
+       be scanned for every term in a single pass.  Returns None if
+       pyahocorasick is not available (or there is nothing to scan
+       for), in which case do_query falls back to per-keyword
+       substring searches"""
+
+    if ahocorasick is None:
+        return None
+
+    auto = ahocorasick.Automaton()
+    for k in keywords:
+        if k.matching == "any":
+            auto.add_word(k.name, k.name)
+        for n in k.excludes:
+            auto.add_word(n, n)
+
+    if len(auto) == 0:
+        return None
+
+    auto.make_automaton()
+    return auto
+
+
 def search_arxiv(keywords, old_id=None, categories=["astro-ph"]):
     """ do the actual search though each requested arxiv category by first querying
         the category for the latest papers and then looking for keyword matches"""
@@ -266,30 +419,53 @@ def search_arxiv(keywords, old_id=None, categories=["astro-ph"]):
 
     max_papers = 1000
 
+    # the keyword set is fixed for the whole run, so build the scanning
+    # automaton once up front
+    automaton = build_automaton(keywords)
+
     cat_papers = []
     cat_last_id = "0000.00000"
 
-    for category in categories:
-        # we pick a wide-enough search range to ensure we catch papers
-        # if there is a holiday
+    # we pick a wide-enough search range to ensure we catch papers
+    # if there is a holiday
 
-        # also, something wierd happens -- the arxiv ids appear to be
-        # in descending order if you look at the "pastweek" listing
-        # but the submission dates can vary wildly.  It seems that some
-        # papers are held for a week or more before appearing.
+    # also, something wierd happens -- the arxiv ids appear to be
+    # in descending order if you look at the "pastweek" listing
+    # but the submission dates can vary wildly.  It seems that some
+    # papers are held for a week or more before appearing.
+    queries = []
+    for category in categories:
         q = ArxivQuery(today - 10*day, today, max_papers, old_id=old_id, category=category)
         print(q.get_url())
+        queries.append(q)
+
+    # each category's query is dominated by the network fetch, so run
+    # them concurrently in a thread pool
+    with ThreadPoolExecutor(max_workers=min(8, len(queries))) as ex:
+        for papers, last_id in ex.map(lambda q: q.do_query(keywords=keywords,
+                                                           old_id=old_id,
+                                                           automaton=automaton),
+                                      queries):
+            cat_papers += papers
+            if _id_key(cat_last_id) < _id_key(last_id):
+                cat_last_id = last_id
+
+    # a paper can be posted to multiple arxiv categories, and each
+    # category's query may have matched different keywords -- merge the
+    # keywords and channels from every appearance rather than keeping
+    # an arbitrary duplicate
+    merged = {}
+    for p in cat_papers:
+        m = merged.get(p.arxiv_id)
+        if m is None:
+            merged[p.arxiv_id] = p
+        else:
+            m.keywords = list(dict.fromkeys(m.keywords + p.keywords))
+            m.channels = list(dict.fromkeys(m.channels + p.channels))
+            m.channel_set = frozenset(m.channels)
+            m._cache_sort_key()
 
-        papers, last_id = q.do_query(keywords=keywords, old_id=old_id)
-
-        cat_papers += papers
-        if float(cat_last_id.split("v")[0]) < float(last_id.split("v")[0]):
-            cat_last_id = last_id
-
-    # a paper can be posted to multiple arxiv categories, so converting
-    # to a set eliminates duplicates and then we sort the papers
-    cat_papers = list(set(cat_papers))
-    cat_papers.sort(reverse=True)
+    cat_papers = sorted(merged.values(), reverse=True)
 
     return cat_papers, cat_last_id
 
@@ -298,18 +474,22 @@ def filter_keyword_requires(papers, channel_req=None):
     # filter out papers that do not match number of required keywords
     if channel_req is None:
         return papers
-    else:
-        filtered_papers = []
-        for p in papers:
-            p.posted_to_slack = False
-        for c in channel_req:
-            for p in papers:
-                if not p.posted_to_slack:
-                    if c in p.channels:
-                        if len(p.keywords) >= channel_req[c]:
-                            filtered_papers.append(p)
-                            p.posted_to_slack = 1
-        return filtered_papers
+
+    # a single pass over the papers -- visit the channels strictest
+    # requirement first, so a paper that qualifies for several channels
+    # is deterministically assigned to the most demanding one.
+    # posted_to_slack doubles as the "already assigned" flag
+    channel_reqs = sorted(channel_req.items(), key=lambda kv: -kv[1])
+    filtered_papers = []
+    for p in papers:
+        p.posted_to_slack = False
+    for p in papers:
+        for c, req in channel_reqs:
+            if c in p.channel_set and len(p.keywords) >= req:
+                filtered_papers.append(p)
+                p.posted_to_slack = 1
+                break
+    return filtered_papers
 
 
 def send_email(papers, mail=None):
@@ -335,34 +515,28 @@ def send_email(papers, mail=None):
             print(body)
 
 
-def run(string):
-    """ run a UNIX command """
-
-    # shlex.split will preserve inner quotes
-    prog = shlex.split(string)
-    p0 = subprocess.Popen(prog, stdout=subprocess.PIPE,
-                          stderr=subprocess.STDOUT)
-
-    stdout0, stderr0 = p0.communicate()
-    rc = p0.returncode
-    p0.stdout.close()
-
-    return stdout0, stderr0, rc
-
-
 def slack_post(papers, channel_req, username=None, icon_emoji=None, webhook=None):
     """ post the information to a slack channel """
 
-    # loop by channel
+    # bin the papers by channel in a single pass, visiting the channels
+    # strictest requirement first so assignment is deterministic --
+    # posted_to_slack keeps us from posting a paper twice
+    channel_reqs = sorted(channel_req.items(), key=lambda kv: -kv[1])
+    by_channel = {c: [] for c in channel_req}
+    for p in papers:
+        if p.posted_to_slack:
+            continue
+        for c, req in channel_reqs:
+            if c in p.channel_set and len(p.keywords) >= req:
+                by_channel[c].append(p)
+                p.posted_to_slack = 1
+                break
+
     for c in channel_req:
         channel_body = ""
-        for p in papers:
-            if not p.posted_to_slack:
-                if c in p.channels:
-                    if len(p.keywords) >= channel_req[c]:
-                        keywds = ", ".join(p.keywords).strip()
-                        channel_body += u"{} [{}]\n\n".format(p, keywds)
-                        p.posted_to_slack = 1
+        for p in by_channel[c]:
+            keywds = ", ".join(p.keywords).strip()
+            channel_body += u"{} [{}]\n\n".format(p, keywds)
 
         if webhook is None:
             print("channel: {}".format(c))
@@ -376,8 +550,10 @@ def slack_post(papers, channel_req, username=None, icon_emoji=None, webhook=None
             payload["icon_emoji"] = icon_emoji
         payload["text"] = channel_body
 
-        cmd = "curl -X POST --data-urlencode 'payload={}' {}".format(json.dumps(payload), webhook)
-        run(cmd)
+        # reuse the shared keep-alive session rather than forking a
+        # curl process (and a new TLS handshake) per channel
+        _SESSION.post(webhook, data={"payload": json.dumps(payload)},
+                      timeout=10)
 
 def doit():
     """ the main driver for the lazy-astroph script """
@@ -429,19 +605,11 @@ def doit():
 
             else:
                 # this line has a keyword (and optional NOT keywords)
-                if "not:" in l:
-                    kw, nots = l.split("not:")
-                    kw = kw.strip()
-                    excludes = [x.strip() for x in nots.split(",")]
-                else:
-                    kw = l.strip()
-                    excludes = []
-
-                if kw[len(kw)-1] == "-":
-                    matching = "unique"
-                    kw = kw[:len(kw)-1]
-                else:
-                    matching = "any"
+                m = KW_RE.match(l)
+                kw = m.group("kw").strip()
+                matching = "unique" if m.group("unique") else "any"
+                nots = m.group("nots")
+                excludes = [x.strip() for x in nots.split(",")] if nots else []
 
                 keywords.append(Keyword(kw, matching=matching,
                                         channel=channel, excludes=excludes))